@@ -155,6 +155,14 @@ class PretrainedModel(Layer, GenerationMixin):
     def get_output_embeddings(self):
         return None  # Overwrite for models with output embeddings
 
+    @staticmethod
+    def _convert_legacy_state_dict(state_dict):
+        """
+        Converts a loaded state dict to the parameter layout of the current
+        model. Overwrite for models whose released weights use an older layout.
+        """
+        return state_dict
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path, *args, **kwargs):
         """
@@ -346,6 +354,7 @@ class PretrainedModel(Layer, GenerationMixin):
         # partial weights. Also we can directly use separate weight files for
         # simplicity.
         state_dict = paddle.load(weight_path, return_numpy=load_state_as_np)
+        state_dict = cls._convert_legacy_state_dict(state_dict)
 
         # Make sure we are able to load base models as well as derived models
         # (with heads)
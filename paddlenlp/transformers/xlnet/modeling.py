@@ -14,6 +14,9 @@
 # limitations under the License.
 """Modeling classes for XLNet model."""
 
+from collections import OrderedDict
+
+import numpy as np
 import paddle
 import paddle.nn as nn
 import paddle.nn.functional as F
@@ -33,6 +36,110 @@ __all__ = [
 
 dtype_float = paddle.get_default_dtype()
 
+# Maximum number of shape-dependent constant tensors cached per model.
+_MAX_CACHE_SIZE = 16
+
+
+def _get_or_create(cache, key, create_fn):
+    # Return the cached value of `key`, creating it with `create_fn` on a miss.
+    # Caching is skipped in static mode where the tensors belong to a program.
+    if not paddle.in_dynamic_mode():
+        return create_fn()
+    value = cache.get(key)
+    if value is None:
+        value = cache[key] = create_fn()
+        if len(cache) > _MAX_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return value
+
+
+@paddle.jit.not_to_static
+def _gpu_device(x):
+    # The GPU that runs the kernels of `x`, or None if it is not on a GPU.
+    # Places are not available on static graph variables, so the current
+    # device is used instead in static mode. The selection runs as plain
+    # Python while a static graph is traced.
+    if paddle.in_dynamic_mode():
+        place = x.place
+        if not place.is_gpu_place():
+            return None
+        return "gpu:{}".format(place.gpu_device_id())
+    device = paddle.get_device()
+    return device if device.startswith("gpu") else None
+
+
+def _on_gpu(x):
+    return _gpu_device(x) is not None
+
+
+# Compute capability of every GPU the model ran on, queried only once.
+_device_capabilities = {}
+
+
+def _on_ampere_or_newer_gpu(x):
+    # The flash attention kernels need compute capability 8.0 or newer.
+    device = _gpu_device(x)
+    if device is None:
+        return False
+    if device not in _device_capabilities:
+        _device_capabilities[device] = (
+            paddle.device.cuda.get_device_capability(device))
+    return _device_capabilities[device][0] >= 8
+
+
+# `scaled_dot_product_attention` is only available in newer versions of Paddle,
+# older versions always use the plain attention implementation.
+scaled_dot_product_attention = getattr(F, "scaled_dot_product_attention",
+                                       None)
+
+try:
+    from paddle.incubate.nn.functional import (
+        fused_bias_dropout_residual_layer_norm)
+except ImportError:
+    fused_bias_dropout_residual_layer_norm = None
+
+try:
+    from paddle.incubate.nn.functional import fused_linear_activation
+except ImportError:
+    fused_linear_activation = None
+
+try:
+    from paddle.incubate import softmax_mask_fuse
+except ImportError:
+    softmax_mask_fuse = None
+
+
+def _dropout_residual_layer_norm(x, residual, dropout, layer_norm, bias=None):
+    # Compute layer_norm(dropout(x + bias) + residual), fused on GPU. The
+    # fused kernel takes float16/float32 inputs with float32 layer norm
+    # parameters, as under `paddle.amp.auto_cast`.
+    if (fused_bias_dropout_residual_layer_norm is not None and
+            x.dtype in (paddle.float16, paddle.float32) and
+            layer_norm.weight.dtype == paddle.float32 and _on_gpu(x)):
+        return fused_bias_dropout_residual_layer_norm(
+            x,
+            residual,
+            bias=bias,
+            ln_scale=layer_norm.weight,
+            ln_bias=layer_norm.bias,
+            dropout_rate=dropout.p,
+            ln_epsilon=layer_norm._epsilon,
+            training=dropout.training,
+            mode=dropout.mode)
+    if bias is not None:
+        x = x + bias
+    return layer_norm(dropout(x) + residual)
+
+
+def _dropout_in_train(dropout, x):
+    # `nn.Dropout` still runs a copy kernel at inference, where it is the
+    # identity in the default `upscale_in_train` mode, so it is skipped there.
+    if dropout.training or dropout.mode != "upscale_in_train":
+        return dropout(x)
+    return x
+
 
 def get_activation(activation_string):
     if activation_string in ACT2FN:
@@ -64,9 +171,52 @@ ACT2FN = {
     "swish": swish,
 }
 
+# Permutations used by the attention helpers below, hoisted out of the hot path.
+# Hidden states are kept batch-first, i.e. heads are laid out as [b, i, n, d].
+_PERM_BIND_TO_BNID = [0, 2, 1, 3]
+_PERM_BIND_TO_NBID = [2, 0, 1, 3]
+_PERM_SND_TO_NDS = [1, 2, 0]
+_PERM_NBIS_TO_BNIS = [1, 0, 2, 3]
+
+
+def _attn_qk(q, k):
+    # Compute einsum("bind,bjnd->bnij", q, k)
+    return paddle.matmul(
+        q.transpose(_PERM_BIND_TO_BNID),
+        k.transpose(_PERM_BIND_TO_BNID),
+        transpose_y=True)
+
+
+def _attn_av(a, v):
+    # Compute einsum("bnij,bjnd->bind", a, v)
+    return paddle.matmul(
+        a, v.transpose(_PERM_BIND_TO_BNID)).transpose(_PERM_BIND_TO_BNID)
+
+
+def _attn_seg(q, seg_embed, seg_mat):
+    # Compute the segment score of every query and key from
+    # ef = einsum("bind,snd->bins", q, seg_embed) and the indicator `seg_mat`.
+    # The batch is folded into the rows of q, so `seg_embed` is shared by all
+    # examples and never stacked or expanded along the batch dimension.
+    bsz, qlen, n_head, d_head = q.shape
+    ef = paddle.matmul(
+        q.transpose(_PERM_BIND_TO_NBID).reshape([n_head, -1, d_head]),
+        seg_embed.transpose(_PERM_SND_TO_NDS))
+    ef = ef.reshape([n_head, bsz, qlen, 2]).transpose(_PERM_NBIS_TO_BNIS)
+    # `seg_mat` is 1 where the key is in another segment than the query, so
+    # it selects between the two segment scores of every query
+    ef_same = ef[:, :, :, :1]
+    return ef_same + seg_mat * (ef[:, :, :, 1:] - ef_same)
+
 
 class XLNetRelativeAttention(Layer):
-    def __init__(self, n_head, d_head, d_model, layer_norm_eps, dropout):
+    def __init__(self,
+                 n_head,
+                 d_head,
+                 d_model,
+                 layer_norm_eps,
+                 dropout,
+                 initializer_range=0.02):
         super(XLNetRelativeAttention, self).__init__()
 
         self.n_head = n_head
@@ -74,25 +224,41 @@ class XLNetRelativeAttention(Layer):
         self.d_model = d_model
         self.scale = 1 / (d_head**0.5)
 
-        self.q = self.create_parameter(
-            [self.d_model, self.n_head * self.d_head])
-        self.k = self.create_parameter(
-            [self.d_model, self.n_head * self.d_head])
-        self.v = self.create_parameter(
-            [self.d_model, self.n_head * self.d_head])
-        self.o = self.create_parameter(
-            [self.d_model, self.n_head * self.d_head])
-        self.r = self.create_parameter(
-            [self.d_model, self.n_head * self.d_head])
+        # Query, key and value projections are fused into one weight of shape
+        # [d_model, 3 * n_head * d_head] so that they take a single GEMM.
+        normal = nn.initializer.Normal(mean=0.0, std=initializer_range)
+        self.qkv = nn.Linear(
+            self.d_model,
+            3 * self.n_head * self.d_head,
+            weight_attr=paddle.ParamAttr(initializer=normal),
+            bias_attr=False)
+        self.o = nn.Linear(
+            self.n_head * self.d_head,
+            self.d_model,
+            weight_attr=paddle.ParamAttr(initializer=normal),
+            bias_attr=False)
+        self.r = nn.Linear(
+            self.d_model,
+            self.n_head * self.d_head,
+            weight_attr=paddle.ParamAttr(initializer=normal),
+            bias_attr=False)
 
         self.r_r_bias = self.create_parameter(
-            [self.n_head, self.d_head], is_bias=True)
+            [self.n_head, self.d_head],
+            is_bias=True,
+            default_initializer=normal)
         self.r_s_bias = self.create_parameter(
-            [self.n_head, self.d_head], is_bias=True)
+            [self.n_head, self.d_head],
+            is_bias=True,
+            default_initializer=normal)
         self.r_w_bias = self.create_parameter(
-            [self.n_head, self.d_head], is_bias=True)
+            [self.n_head, self.d_head],
+            is_bias=True,
+            default_initializer=normal)
         self.seg_embed = self.create_parameter(
-            [2, self.n_head, self.d_head], is_bias=False)
+            [2, self.n_head, self.d_head],
+            is_bias=False,
+            default_initializer=normal)
 
         self.layer_norm = nn.LayerNorm(d_model, epsilon=layer_norm_eps)
         self.dropout = nn.Dropout(dropout)
@@ -100,18 +266,53 @@ class XLNetRelativeAttention(Layer):
     def prune_heads(self, heads):
         raise NotImplementedError
 
+    @staticmethod
+    def _use_fused_attention(q_head, head_mask, output_attentions):
+        # The fused kernel only supports half precision on Ampere and newer
+        # GPUs and does not expose the attention probabilities. It does not
+        # compute the gradient of the additive bias either, which carries the
+        # positional and segment scores, so it is only used when no gradient
+        # is recorded. Static graphs may be trained and always skip it.
+        return (scaled_dot_product_attention is not None and
+                not output_attentions and head_mask is None and
+                q_head.dtype in (paddle.float16, paddle.bfloat16) and
+                paddle.in_dynamic_mode() and not paddle.is_grad_enabled() and
+                _on_ampere_or_newer_gpu(q_head))
+
+    @staticmethod
+    def _use_fused_softmax_mask(attn_score):
+        # The fused kernel is GPU only, and is limited to float32/float16 and
+        # to key lengths in [32, 8192) with whole blocks of query rows.
+        qlen, klen = attn_score.shape[2], attn_score.shape[3]
+        return (softmax_mask_fuse is not None and
+                attn_score.dtype == paddle.float32 and 32 <= klen < 8192 and
+                qlen % 8 == 0 and _on_gpu(attn_score))
+
+    def project_qkv(self, h, cat):
+        """Content-based query, key and value heads from one fused GEMM."""
+        # Project `cat` with the [h, 3*n*d] weight of the `qkv` Linear and
+        # split the result into the [b, i, n, d] heads.
+        # With memory prepended, queries only exist for the last `qlen` steps.
+        qkv = self.qkv(cat)
+        q_head, k_head, v_head = paddle.split(qkv, 3, axis=-1)
+        if cat is not h:
+            q_head = q_head[:, -h.shape[1]:]
+        shape = [0, 0, self.n_head, self.d_head]
+        return (paddle.reshape(q_head, shape), paddle.reshape(k_head, shape),
+                paddle.reshape(v_head, shape))
+
     @staticmethod
     def rel_shift_bnij(x, klen=-1):
         # Relative shift of the attention matrix from bd~ to bd (refer to Appendix B in the Transformer-XL paper)
+        # The batch and head dimensions are copied from the input with `0`,
+        # as a broadcast positional encoding leaves a batch of 1 in the
+        # static shape of `x` when the graph is exported with a dynamic batch.
         x_size = x.shape
 
-        x = paddle.reshape(x, [x_size[0], x_size[1], x_size[3], x_size[2]])
+        x = paddle.reshape(x, [0, 0, x_size[3], -1])
         x = x[:, :, 1:, :]
-        x = paddle.reshape(x, [x_size[0], x_size[1], x_size[2], x_size[3] - 1])
-        x = paddle.index_select(
-            x, index=paddle.arange(
-                klen, dtype='int64'), axis=3)
-        return x
+        x = paddle.reshape(x, [0, 0, x_size[2], -1])
+        return x[:, :, :, :klen]
 
     def rel_attn_core(
             self,
@@ -123,63 +324,98 @@ class XLNetRelativeAttention(Layer):
             attn_mask=None,
             head_mask=None,
             output_attentions=False, ):
-        """Core relative positional attention operations."""
+        """Core relative positional attention operations.
 
-        # Content based attention score (refer to the Transformer-XL paper)
-        # q_head = Exi * Wq; self.r_w_bias = u; k_head_h = Wke * Exj
-        # a = Exi * Wq * Wke * Exj; c = u * Wke * Exj; ac = a + c
-        ac = paddle.einsum("ibnd,jbnd->bnij", q_head + self.r_w_bias, k_head_h)
+        `attn_mask` is an additive bias, 0 where attention is allowed and
+        -1e30 where it is masked.
+        """
+
+        # The scale is applied to the queries and biases rather than to the
+        # much larger [b, n, i, j] scores
+        q_scaled = q_head * self.scale
 
         # Position based attention score (refer to the Transformer-XL paper)
         # q_head = Exi * Wq; self.r_r_bias = v; k_head_r = Wkr * Rij
         # b = Exi * Wq * Wkr * Rij; d = v * Wkr * Rij; bd = b + d
-        bd = paddle.einsum("ibnd,jbnd->bnij", q_head + self.r_r_bias, k_head_r)
-        bd = self.rel_shift_bnij(bd, klen=ac.shape[3])
+        bd = _attn_qk(q_scaled + self.r_r_bias * self.scale, k_head_r)
+        bd = self.rel_shift_bnij(bd, klen=k_head_h.shape[1])
 
         # Segment based attention score
         if seg_mat is None:
             ef = 0
         else:
-            ef = paddle.einsum('ibnd,snd->ibns', q_head + self.r_s_bias,
-                               self.seg_embed)
-            ef = paddle.einsum('ijbs,ibns->bnij', seg_mat, ef)
+            ef = _attn_seg(q_scaled + self.r_s_bias * self.scale,
+                           self.seg_embed, seg_mat)
+
+        if self._use_fused_attention(q_head, head_mask, output_attentions):
+            # The content based score, scaling, softmax, dropout and the
+            # attention output are computed by one fused kernel, with the
+            # positional and segment scores passed in as an additive bias.
+            attn_bias = bd + ef
+            if attn_mask is not None:
+                # -1e30 overflows in float16, use a bias that stays finite
+                attn_bias = attn_bias + paddle.clip(
+                    attn_mask, min=-1e4).astype(attn_bias.dtype)
+            return scaled_dot_product_attention(
+                q_head + self.r_w_bias,
+                k_head_h,
+                v_head_h,
+                attn_mask=attn_bias,
+                dropout_p=self.dropout.p,
+                training=self.training)
 
-        # Merge attention scores and perform masking
-        attn_score = (ac + bd + ef) * self.scale
+        # Content based attention score (refer to the Transformer-XL paper)
+        # q_head = Exi * Wq; self.r_w_bias = u; k_head_h = Wke * Exj
+        # a = Exi * Wq * Wke * Exj; c = u * Wke * Exj; ac = a + c
+        ac = _attn_qk(q_scaled + self.r_w_bias * self.scale, k_head_h)
 
-        if attn_mask is not None:
-            attn_mask = attn_mask.transpose([2, 3, 0, 1])
-            attn_score = attn_score - 1e30 * attn_mask
+        # Merge attention scores and perform masking, half precision scores
+        # are upcast so that the softmax runs in float32
+        attn_score = ac + bd + ef
+        half_precision = attn_score.dtype in (paddle.float16, paddle.bfloat16)
+        if half_precision:
+            attn_score = paddle.cast(attn_score, "float32")
 
         # Attention probability
-        attn_prob = F.softmax(attn_score, axis=3)
+        if attn_mask is not None and self._use_fused_softmax_mask(attn_score):
+            # Add the mask and normalize in a single pass over the scores.
+            # The kernel does not broadcast, the mask needs a row for every
+            # example and query, e.g. a padding-only [b, 1, 1, klen] mask.
+            bsz, _, qlen, klen = attn_score.shape
+            if attn_mask.shape[0] != bsz or attn_mask.shape[2] != qlen:
+                attn_mask = attn_mask.expand([bsz, 1, qlen, klen])
+            attn_prob = softmax_mask_fuse(attn_score, attn_mask)
+        else:
+            if attn_mask is not None:
+                attn_score = attn_score + attn_mask
+            attn_prob = F.softmax(attn_score, axis=3)
+        if half_precision:
+            attn_prob = paddle.cast(attn_prob, v_head_h.dtype)
         attn_prob = self.dropout(attn_prob)
 
         # Mask heads if we want to
         if head_mask is not None:
-            attn_prob = attn_prob * head_mask.transpose([2, 3, 0, 1])
+            attn_prob = attn_prob * head_mask
 
         # Attention output
-        attn_vec = paddle.einsum("bnij,jbnd->ibnd", attn_prob, v_head_h)
+        attn_vec = _attn_av(attn_prob, v_head_h)
 
         if output_attentions:
-            return attn_vec, attn_prob.transpose([2, 3, 0, 1])
+            return attn_vec, attn_prob
         return attn_vec
 
     def post_attention(self, h, attn_vec, residual=True):
         """Post-attention processing."""
         # Post-attention projection (back to 'd_model')
-        # Compute einsum4x4("ibnd,hnd->ibh", attn_vec, self.o)
+        # The heads are flattened and projected by the `o` Linear
         shape = attn_vec.shape
         attn_vec = attn_vec.reshape([shape[0], shape[1], -1])
-        attn_out = paddle.einsum("ibm,hm->ibh", attn_vec, self.o)
+        attn_out = self.o(attn_vec)
 
-        attn_out = self.dropout(attn_out)
         if residual:
-            attn_out = attn_out + h
-
-        output = self.layer_norm(attn_out)
-        return output
+            return _dropout_residual_layer_norm(attn_out, h, self.dropout,
+                                                self.layer_norm)
+        return self.layer_norm(self.dropout(attn_out))
 
     def forward(
             self,
@@ -193,44 +429,23 @@ class XLNetRelativeAttention(Layer):
             target_mapping=None,
             head_mask=None,
             output_attentions=False, ):
-        if g is not None:
-            # Two-stream attention with relative positional encoding.
-            # Content based attention score
-            if mems is not None and mems.dim() > 1:
-                cat = paddle.concat([mems, h], axis=0)
-            else:
-                cat = h
-
-            # Content-based key head
-            # Compute k_head_h = einsum4x4("ibh,h(n*d)->ibnd", cat, self.k)
-            k_head_h = paddle.matmul(cat, self.k)
-            k_head_h = paddle.reshape(
-                k_head_h,
-                shape=[cat.shape[0], cat.shape[1], self.n_head, self.d_head])
+        if mems is not None and mems.dim() > 1:
+            cat = paddle.concat([mems, h], axis=1)
+        else:
+            cat = h
 
-            # Content-based value head
-            # Compute v_head_h = einsum4x4("ibh,h(n*d)->ibnd", cat, self.v)
-            v_head_h = paddle.matmul(cat, self.v)
-            v_head_h = paddle.reshape(
-                v_head_h,
-                shape=[cat.shape[0], cat.shape[1], self.n_head, self.d_head])
+        # Content heads
+        q_head_h, k_head_h, v_head_h = self.project_qkv(h, cat)
 
-            # Position-based key head
-            # Compute k_head_r = einsum4x4("ibh,h(n*d)->ibnd", r, self.r)
-            k_head_r = paddle.matmul(r, self.r)
-            k_head_r = paddle.reshape(
-                k_head_r,
-                shape=[r.shape[0], r.shape[1], self.n_head, self.d_head])
+        # Position-based key head
+        # Project `r` with the `r` Linear and split it into [b, j, n, d] heads
+        k_head_r = self.r(r)
+        k_head_r = paddle.reshape(
+            k_head_r, shape=[0, 0, self.n_head, self.d_head])
 
+        if g is not None:
+            # Two-stream attention with relative positional encoding.
             # H-stream
-            # Content-stream query head
-            # Compute q_head_h = einsum4x4("ibh,h(n*d)->ibnd", h, self.q)
-            q_head_h = paddle.matmul(h, self.q)  # shape
-            q_head_h = paddle.reshape(
-                q_head_h,
-                shape=[h.shape[0], h.shape[1], self.n_head, self.d_head])
-
-            # Core attention ops
             attn_vec_h = self.rel_attn_core(
                 q_head_h,
                 k_head_h,
@@ -248,17 +463,22 @@ class XLNetRelativeAttention(Layer):
             output_h = self.post_attention(h, attn_vec_h)
 
             # G-stream
-            # Query-stream query head
-            # Compute q_head_g = einsum4x4("ibh,hnd->ibnd", g, self.q)
-            shape = g.shape
-            q_head_g = paddle.matmul(g, self.q).reshape(
-                [shape[0], shape[1], self.n_head, self.d_head])
+            # Query-stream query head, projected with the query slice of the
+            # `qkv` Linear weight: q_head_g = g @ qkv.weight[:, :n*d]
+            q_head_g = paddle.matmul(
+                g, self.qkv.weight[:, :self.n_head * self.d_head])
+            q_head_g = paddle.reshape(
+                q_head_g, shape=[0, 0, self.n_head, self.d_head])
 
             # Core attention ops
             if target_mapping is not None:
-                # Compute q_head_g = einsum4x4("mbnd,mlb->lbnd", q_head_g, target_mapping)
-                q_head_g = paddle.einsum("mbnd,mlb->lbnd", q_head_g,
-                                         target_mapping)
+                # Compute q_head_g = einsum("bmnd,bml->blnd", q_head_g, target_mapping)
+                # as a single batched GEMM over the flattened heads
+                q_head_g = paddle.matmul(
+                    target_mapping,
+                    q_head_g.reshape([0, 0, -1]),
+                    transpose_x=True).reshape(
+                        [0, 0, self.n_head, self.d_head])
                 attn_vec_g = self.rel_attn_core(
                     q_head_g,
                     k_head_h,
@@ -272,9 +492,10 @@ class XLNetRelativeAttention(Layer):
                 if output_attentions:
                     attn_vec_g, attn_prob_g = attn_vec_g
 
-                # Compute attn_vec_g = einsum4x4("lbnd,mlb->mbnd", attn_vec_g, target_mapping)
-                attn_vec_g = paddle.einsum("lbnd,mlb->mbnd", attn_vec_g,
-                                           target_mapping)
+                # Compute attn_vec_g = einsum("blnd,bml->bmnd", attn_vec_g, target_mapping)
+                attn_vec_g = paddle.matmul(
+                    target_mapping, attn_vec_g.reshape([0, 0, -1])).reshape(
+                        [0, 0, self.n_head, self.d_head])
 
             else:
                 attn_vec_g = self.rel_attn_core(
@@ -298,37 +519,6 @@ class XLNetRelativeAttention(Layer):
 
         else:
             # Multi-head attention with relative positional encoding
-            if mems is not None and mems.dim() > 1:
-                cat = paddle.concat([mems, h], axis=0)
-            else:
-                cat = h
-
-            # Content heads
-            # Compute q_head_h = einsum4x4("ibh,hnd->ibnd", h, self.q)
-            q_head_h = paddle.matmul(h, self.q)
-            q_head_h = paddle.reshape(
-                q_head_h,
-                shape=[h.shape[0], h.shape[1], self.n_head, self.d_head])
-
-            # Compute k_head_h = einsum4x4("ibh,hnd->ibnd", cat, self.k)
-            k_head_h = paddle.matmul(cat, self.k)
-            k_head_h = paddle.reshape(
-                k_head_h,
-                shape=[h.shape[0], h.shape[1], self.n_head, self.d_head])
-
-            # Compute v_head_h = einsum4x4("ibh,hnd->ibnd", cat, self.v)
-            v_head_h = paddle.matmul(cat, self.v)
-            v_head_h = paddle.reshape(
-                v_head_h,
-                shape=[h.shape[0], h.shape[1], self.n_head, self.d_head])
-
-            # Position-based key head
-            # Compute k_head_r = einsum4x4("ibh,hnd->ibnd", r, self.r)
-            k_head_r = paddle.matmul(r, self.r)
-            k_head_r = paddle.reshape(
-                k_head_r,
-                shape=[k_head_r.shape[0], -1, self.n_head, self.d_head])
-
             # Core attention ops
             attn_vec = self.rel_attn_core(
                 q_head_h,
@@ -361,27 +551,50 @@ class XLNetFeedForward(Layer):
             d_inner,
             layer_norm_eps,
             dropout,
-            ff_activation, ):
+            ff_activation,
+            initializer_range=0.02, ):
         super(XLNetFeedForward, self).__init__()
 
         self.layer_norm = nn.LayerNorm(d_model, epsilon=layer_norm_eps)
-        self.layer_1 = nn.Linear(d_model, d_inner)
-        self.layer_2 = nn.Linear(d_inner, d_model)
+        self.layer_1 = nn.Linear(
+            d_model,
+            d_inner,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range)))
+        self.layer_2 = nn.Linear(
+            d_inner,
+            d_model,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range)))
         self.dropout = nn.Dropout(dropout)
+        # The cuBLASLt GELU epilogue uses the tanh approximation, so only the
+        # exact relu epilogue is fused into layer_1.
+        self.fused_activation = "relu" if ff_activation == "relu" else None
         if isinstance(ff_activation, str):
             self.activation_function = ACT2FN[ff_activation]
         else:
             self.activation_function = ff_activation
 
     def forward(self, inp):
-        output = inp
-        output = self.layer_1(output)
-        output = self.activation_function(output)
-        output = self.dropout(output)
-        output = self.layer_2(output)
+        # Compute linear + bias + activation in one GEMM epilogue
+        if (fused_linear_activation is not None and self.fused_activation and
+                _on_gpu(inp)):
+            output = fused_linear_activation(
+                inp,
+                self.layer_1.weight,
+                self.layer_1.bias,
+                activation=self.fused_activation)
+        else:
+            output = self.activation_function(self.layer_1(inp))
         output = self.dropout(output)
-        output = self.layer_norm(output + inp)
-        return output
+        # Leave the bias of layer_2 to the fused residual layer norm
+        output = paddle.matmul(output, self.layer_2.weight)
+        return _dropout_residual_layer_norm(
+            output,
+            inp,
+            self.dropout,
+            self.layer_norm,
+            bias=self.layer_2.bias)
 
 
 class XLNetLayer(Layer):
@@ -393,13 +606,15 @@ class XLNetLayer(Layer):
             layer_norm_eps,
             dropout,
             d_inner,
-            ff_activation, ):
+            ff_activation,
+            initializer_range=0.02, ):
         super(XLNetLayer, self).__init__()
 
         self.rel_attn = XLNetRelativeAttention(n_head, d_head, d_model,
-                                               layer_norm_eps, dropout)
+                                               layer_norm_eps, dropout,
+                                               initializer_range)
         self.ff = XLNetFeedForward(d_model, d_inner, layer_norm_eps, dropout,
-                                   ff_activation)
+                                   ff_activation, initializer_range)
         self.seq_len_dim = 1
 
     def forward(
@@ -563,9 +778,44 @@ class XLNetPretrainedModel(PretrainedModel):
     base_model_prefix = "transformer"
 
     def init_weights(self):
-        # Initialize weights
+        # Re-initialize weights. Parameters already get the same initializers
+        # when they are created, so the constructors do not call this.
         self.apply(self._init_weights)
 
+    @staticmethod
+    def _convert_legacy_state_dict(state_dict):
+        # Released checkpoints keep the attention projections as bare
+        # parameters with separate `q`, `k` and `v`, while
+        # `XLNetRelativeAttention` uses `nn.Linear` layers with `q`, `k` and
+        # `v` fused into `qkv`. `o` was stored as the transpose of its weight.
+        # `from_pretrained` converts the weights before they are cast to the
+        # dtype of the parameters.
+        state_dict = dict(state_dict)
+        for key in [k for k in state_dict.keys() if k.endswith("rel_attn.q")]:
+            prefix = key[:-len("q")]
+            weights = [state_dict.pop(prefix + name) for name in "qkv"]
+            if isinstance(weights[0], np.ndarray):
+                state_dict[prefix + "qkv"] = np.concatenate(weights, axis=1)
+            else:
+                state_dict[prefix + "qkv"] = paddle.concat(weights, axis=1)
+        for key in [
+                k for k in state_dict.keys()
+                if k.endswith(("rel_attn.qkv", "rel_attn.o", "rel_attn.r"))
+        ]:
+            weight = state_dict.pop(key)
+            if key.endswith("rel_attn.o"):
+                weight = weight.T
+            state_dict[key + ".weight"] = weight
+        return state_dict
+
+    def set_state_dict(self, state_dict, *args, **kwargs):
+        return super(XLNetPretrainedModel, self).set_state_dict(
+            self._convert_legacy_state_dict(state_dict), *args, **kwargs)
+
+    # `Layer.set_dict` and `Layer.load_dict` are aliases of the original
+    # `set_state_dict`, so they are rebound to convert legacy layouts as well.
+    set_dict = load_dict = set_state_dict
+
     def _init_weights(self, layer):
         # Initialize the weights.
         if isinstance(layer, (nn.Linear, nn.Embedding)):
@@ -576,7 +826,8 @@ class XLNetPretrainedModel(PretrainedModel):
                         std=self.initializer_range
                         if hasattr(self, "initializer_range") else
                         self.transformer.config["initializer_range"],
-                        shape=layer.weight.shape))
+                        shape=layer.weight.shape).astype(
+                            layer.weight.dtype))
             if isinstance(layer, nn.Linear) and layer.bias is not None:
                 layer.bias.set_value(paddle.zeros_like(layer.bias))
         elif isinstance(layer, nn.LayerNorm):
@@ -584,11 +835,6 @@ class XLNetPretrainedModel(PretrainedModel):
             layer.weight.set_value(paddle.full_like(layer.weight, 1.0))
         elif isinstance(layer, XLNetRelativeAttention):
             for param in [
-                    layer.q,
-                    layer.k,
-                    layer.v,
-                    layer.o,
-                    layer.r,
                     layer.r_r_bias,
                     layer.r_s_bias,
                     layer.r_w_bias,
@@ -600,7 +846,7 @@ class XLNetPretrainedModel(PretrainedModel):
                         std=self.initializer_range
                         if hasattr(self, "initializer_range") else
                         self.transformer.config["initializer_range"],
-                        shape=param.shape))
+                        shape=param.shape).astype(param.dtype))
         elif isinstance(layer, XLNetModel):
             layer.mask_emb.set_value(
                 paddle.tensor.normal(
@@ -608,7 +854,8 @@ class XLNetPretrainedModel(PretrainedModel):
                     std=self.initializer_range
                     if hasattr(self, "initializer_range") else
                     self.transformer.config["initializer_range"],
-                    shape=layer.mask_emb.shape))
+                    shape=layer.mask_emb.shape).astype(
+                        layer.mask_emb.dtype))
 
 
 @register_base_model
@@ -623,6 +870,14 @@ class XLNetModel(XLNetPretrainedModel):
     /docs/en/api/paddle/fluid/dygraph/layers/Layer_en.html>`__ subclass. Use it as a regular Paddle Layer
     and refer to the Paddle documentation for all matter related to general usage and behavior.
 
+    On GPU the model can run in half precision, either under `paddle.amp.auto_cast` (e.g. with
+    ``dtype='bfloat16'``) or after casting its parameters with `paddle.nn.Layer.to`. The fused
+    kernels are only used for the dtypes they support, e.g. layer norms with half precision
+    parameters run unfused.
+    Attention scores are always normalized in `float32`. Half precision inference under
+    `paddle.no_grad` on Ampere and newer GPUs uses a fused attention kernel, and on these
+    GPUs Paddle runs `float32` matmuls with TensorFloat32 by default.
+
     Args:
         vocab_size (int):
             Vocabulary size of `inputs_ids` in `XLNetModel`.
@@ -687,7 +942,8 @@ class XLNetModel(XLNetPretrainedModel):
 
             .. note::
                 A normal_initializer initializes weight matrices as normal distributions.
-                See :meth:`XLNetPretrainedModel._init_weights()` for how weights are initialized in `XLNetModel`.
+                Weights are initialized when the parameters are created, and
+                :meth:`XLNetPretrainedModel.init_weights()` re-initializes them the same way.
     """
 
     def __init__(
@@ -720,8 +976,21 @@ class XLNetModel(XLNetPretrainedModel):
         self.clamp_len = clamp_len
         self.n_layer = n_layer
         self.dropout = nn.Dropout(dropout)
-        self.word_embedding = nn.Embedding(vocab_size, d_model)
-        self.mask_emb = self.create_parameter([1, 1, d_model])
+        self.word_embedding = nn.Embedding(
+            vocab_size,
+            d_model,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range)))
+        self.mask_emb = self.create_parameter(
+            [1, 1, d_model],
+            default_initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range))
+        self._pos_emb_cache = OrderedDict()
+        self._mask_cache = OrderedDict()
+        # Inverse frequencies of the sinusoid positional encoding
+        freq_seq = paddle.arange(0, d_model, 2.0, dtype=dtype_float)
+        self.register_buffer(
+            "inv_freq", 1 / 10000**(freq_seq / d_model), persistable=False)
         self.layer = nn.LayerList([
             XLNetLayer(
                 n_head,
@@ -730,17 +999,49 @@ class XLNetModel(XLNetPretrainedModel):
                 layer_norm_eps,
                 dropout,
                 d_inner,
-                ff_activation, ) for _ in range(n_layer)
+                ff_activation,
+                initializer_range, ) for _ in range(n_layer)
         ])
 
-        self.init_weights()
-
     def get_input_embeddings(self):
         return self.word_embedding
 
     def set_input_embeddings(self, new_embeddings):
         self.word_embedding = new_embeddings
 
+    def to_static_layers(self, build_cinn_pass=False):
+        """
+        Converts the forward of every :class:`XLNetLayer` and the attention
+        mask preparation into static graphs with `paddle.jit.to_static`, while
+        the rest of the model stays in dynamic mode. This removes the Python
+        overhead of the many small ops in each layer and in the mask prologue,
+        and lets CINN fuse them when `build_cinn_pass` is set. A program is
+        built for each new input shape and combination of given masks, so this
+        pays off when they stay the same across steps.
+
+        Args:
+            build_cinn_pass (bool, optional):
+                Whether or not to compile the layers with CINN. Paddle has to
+                be built with CINN support. Defaults to `False`.
+
+        Example:
+            .. code-block::
+
+                from paddlenlp.transformers.xlnet.modeling import XLNetModel
+
+                model = XLNetModel.from_pretrained('xlnet-base-cased')
+                model.to_static_layers()
+        """
+        build_strategy = paddle.static.BuildStrategy()
+        build_strategy.build_cinn_pass = build_cinn_pass
+        for layer in self.layer:
+            layer.forward = paddle.jit.to_static(
+                layer.forward, build_strategy=build_strategy, full_graph=True)
+        self._prepare_masks = paddle.jit.to_static(
+            self._prepare_masks,
+            build_strategy=build_strategy,
+            full_graph=True)
+
     def _prune_heads(self, heads_to_prune):
         raise NotImplementedError
 
@@ -757,10 +1058,85 @@ class XLNetModel(XLNetPretrainedModel):
 
         return ret
 
+    def _prepare_masks(self,
+                       qlen,
+                       mlen,
+                       attention_mask=None,
+                       input_mask=None,
+                       perm_mask=None):
+        # Builds the additive attention biases of the query stream and of the
+        # content stream, which can also attend to the token itself.
+        klen = mlen + qlen
+
+        # Causal attention mask
+        if self.attn_type == "uni":
+            # The causal mask only depends on the lengths, so it is reused
+            # by the following forward passes with the same shapes.
+            attn_mask = _get_or_create(
+                self._mask_cache,
+                ("causal", qlen, mlen, self.same_length, paddle.get_device()),
+                lambda: paddle.unsqueeze(
+                    self.create_mask(qlen, mlen), axis=[0, 1]) > 0)
+        elif self.attn_type == "bi":
+            attn_mask = None
+        else:
+            raise ValueError("Unsupported attention type: {}".format(
+                self.attn_type))
+
+        # Data mask: input mask & perm mask
+        # All mems can be attended to, so every mask is left padded along the
+        # key axis before it is turned into a boolean
+        data_mask = None
+        if input_mask is not None:
+            data_mask = paddle.unsqueeze(input_mask, axis=1)
+            if mlen > 0:
+                data_mask = F.pad(data_mask, [mlen, 0], data_format="NCL")
+            data_mask = data_mask > 0
+        elif attention_mask is not None:
+            # `attention_mask` is the negation of `input_mask`, which is
+            # folded into the comparison rather than computed
+            data_mask = paddle.unsqueeze(attention_mask, axis=1)
+            if mlen > 0:
+                data_mask = F.pad(
+                    data_mask, [mlen, 0], value=1.0, data_format="NCL")
+            data_mask = data_mask < 1
+        if perm_mask is not None:
+            if mlen > 0:
+                perm_mask = F.pad(perm_mask, [mlen, 0], data_format="NCL")
+            perm_mask = perm_mask > 0
+            if data_mask is None:
+                data_mask = perm_mask
+            else:
+                data_mask = paddle.logical_or(data_mask, perm_mask)
+
+        if data_mask is not None:
+            data_mask = paddle.unsqueeze(data_mask, axis=1)
+            if attn_mask is None:
+                attn_mask = data_mask
+            else:
+                attn_mask = paddle.logical_or(attn_mask, data_mask)
+
+        # The masks are composed as booleans and only turned into additive
+        # biases once, so that every layer masks its scores with a single add
+        if attn_mask is not None:
+            # The content stream can always attend to the token itself
+            not_self = _get_or_create(
+                self._mask_cache, ("not_self", qlen, mlen, paddle.get_device()),
+                lambda: paddle.arange(klen) != paddle.unsqueeze(
+                    paddle.arange(mlen, klen), axis=-1))
+            non_tgt_mask = paddle.logical_and(attn_mask, not_self)
+
+            attn_mask = paddle.cast(attn_mask, dtype=dtype_float) * -1e30
+            non_tgt_mask = paddle.cast(non_tgt_mask, dtype=dtype_float) * -1e30
+        else:
+            non_tgt_mask = None
+
+        return attn_mask, non_tgt_mask
+
     def cache_mem(self, curr_out, prev_mem):
         # Cache hidden states into memory.
         if self.reuse_len is not None and self.reuse_len > 0:
-            curr_out = curr_out[:self.reuse_len]
+            curr_out = curr_out[:, :self.reuse_len]
 
         if self.mem_len is None or self.mem_len == 0:
             # If `use_mems` is active but no `mem_len` is defined, the model behaves like GPT-2 at inference time
@@ -772,29 +1148,57 @@ class XLNetModel(XLNetPretrainedModel):
             cutoff = -self.mem_len
         if prev_mem is None:
             # If :obj:`use_mems` is active and `mem_len` is defined, the model
-            new_mem = curr_out[cutoff:]
+            new_mem = curr_out[:, cutoff:]
+        elif cutoff == 0:
+            new_mem = paddle.concat([prev_mem, curr_out], axis=1)
         else:
-            new_mem = paddle.concat([prev_mem, curr_out], axis=0)[cutoff:]
+            # Only the part of `prev_mem` that survives the cutoff is copied,
+            # so every step writes at most `mem_len` positions.
+            keep = self.mem_len - curr_out.shape[1]
+            if keep > 0:
+                new_mem = paddle.concat(
+                    [prev_mem[:, -keep:], curr_out], axis=1)
+            else:
+                new_mem = curr_out[:, cutoff:]
 
         return new_mem.detach()
 
     @staticmethod
     def positional_embedding(pos_seq, inv_freq, bsz=None):
-        # Compute sinusoid_inp = einsum4x4("i,d->id", pos_seq, inv_freq)
+        # Compute sinusoid_inp = einsum("i,d->id", pos_seq, inv_freq)
         sinusoid_inp = paddle.einsum("i,d->id", pos_seq, inv_freq)
         pos_emb = paddle.concat(
             [paddle.sin(sinusoid_inp), paddle.cos(sinusoid_inp)], axis=-1)
-        pos_emb = paddle.unsqueeze(pos_emb, axis=1)
+        pos_emb = paddle.unsqueeze(pos_emb, axis=0)
         if bsz is not None:
-            pos_emb = pos_emb.expand([-1, bsz, -1])
+            pos_emb = pos_emb.expand([bsz, -1, -1])
             pos_emb.stop_gradient = True
         pos_emb.stop_gradient = True
         return pos_emb
 
     def relative_positional_encoding(self, qlen, klen, bsz=None):
-        # Create relative positional encoding.
-        freq_seq = paddle.arange(0, self.d_model, 2.0, dtype=dtype_float)
-        inv_freq = 1 / 10000**(freq_seq / self.d_model)
+        # The encoding is constant for given shapes, so it is created once and
+        # reused by the following forward passes with the same shapes. Only
+        # the encoding shared by the batch is cached, and it is expanded to
+        # `bsz` after the lookup so that no batch-sized copy is kept alive.
+        key = (qlen, klen, self.attn_type, self.bi_data, self.clamp_len,
+               paddle.get_device(), self.word_embedding.weight.dtype)
+        pos_emb = _get_or_create(
+            self._pos_emb_cache, key,
+            lambda: self._relative_positional_encoding(qlen, klen))
+        if bsz is not None:
+            if self.bi_data:
+                # Forward encodings for the first half of the batch and
+                # backward encodings for the second half
+                pos_emb = paddle.repeat_interleave(pos_emb, bsz // 2, axis=0)
+            else:
+                pos_emb = pos_emb.expand([bsz, -1, -1])
+        return pos_emb
+
+    def _relative_positional_encoding(self, qlen, klen):
+        # Create relative positional encoding. The sinusoids are computed in
+        # float32 and cast to the dtype of the embeddings afterwards.
+        inv_freq = paddle.cast(self.inv_freq, dtype_float)
 
         if self.attn_type == "bi":
             beg, end = klen, -qlen
@@ -811,21 +1215,15 @@ class XLNetModel(XLNetPretrainedModel):
                 fwd_pos_seq = fwd_pos_seq.clamp(-self.clamp_len, self.clamp_len)
                 bwd_pos_seq = bwd_pos_seq.clamp(-self.clamp_len, self.clamp_len)
 
-            if bsz is not None:
-                fwd_pos_emb = self.positional_embedding(fwd_pos_seq, inv_freq,
-                                                        bsz // 2)
-                bwd_pos_emb = self.positional_embedding(bwd_pos_seq, inv_freq,
-                                                        bsz // 2)
-            else:
-                fwd_pos_emb = self.positional_embedding(fwd_pos_seq, inv_freq)
-                bwd_pos_emb = self.positional_embedding(bwd_pos_seq, inv_freq)
-            pos_emb = paddle.concat([fwd_pos_emb, bwd_pos_emb], axis=1)
+            fwd_pos_emb = self.positional_embedding(fwd_pos_seq, inv_freq)
+            bwd_pos_emb = self.positional_embedding(bwd_pos_seq, inv_freq)
+            pos_emb = paddle.concat([fwd_pos_emb, bwd_pos_emb], axis=0)
         else:
             fwd_pos_seq = paddle.arange(beg, end, -1.0, dtype=dtype_float)
             if self.clamp_len > 0:
                 fwd_pos_seq = fwd_pos_seq.clamp(-self.clamp_len, self.clamp_len)
-            pos_emb = self.positional_embedding(fwd_pos_seq, inv_freq, bsz)
-        return pos_emb
+            pos_emb = self.positional_embedding(fwd_pos_seq, inv_freq)
+        return paddle.cast(pos_emb, self.word_embedding.weight.dtype)
 
     def forward(
             self,
@@ -840,7 +1238,8 @@ class XLNetModel(XLNetPretrainedModel):
             inputs_embeds=None,
             use_mems_train=False,
             use_mems_eval=False,
-            return_dict=False, ):
+            return_dict=False,
+            return_last_only=False, ):
         r"""
         The XLNetModel forward method, overrides the `__call__()` special method.
 
@@ -901,6 +1300,8 @@ class XLNetModel(XLNetPretrainedModel):
                 - 0 for tokens that are **not masked**.
 
                 You should use only one of `input_mask` and `attention_mask`. Defaults to `None`.
+                Batches without padding should leave both of them as `None`, in which case
+                no data mask is built at all.
             head_mask (Tensor, optional):
                 Mask to nullify selected heads of the self-attention layers with values being either 0 or 1.
 
@@ -925,6 +1326,11 @@ class XLNetModel(XLNetPretrainedModel):
                 If True, then returns information about `output`, `new_mems`, `hidden_states` and `attentions`
                 which will also be formatted as a dict. Else only returns the output tensor.
                 Defaults to False.
+            return_last_only (bool, optional):
+                Whether or not to only return the output of the last position, with a shape of
+                [batch_size, 1, hidden_size], as used by the sequence-level classification heads.
+                `mems`, `hidden_states` and `attentions` are not affected.
+                Defaults to False.
 
         Returns:
             Tensor or dict: Returns tensor `output` or a dict with key-value pairs:
@@ -977,95 +1383,33 @@ class XLNetModel(XLNetPretrainedModel):
         else:
             use_mems = use_mems_eval
 
-        # The original code for XLNet uses shapes [len, bsz] with the batch dimension at the end
-        # but we want a unified interface in the library with the batch size on the first dimension
-        # so we move here the first dimension (batch) to the end
+        # The original code for XLNet uses shapes [len, bsz] with the batch dimension at the end.
+        # We keep the batch size on the first dimension throughout instead, which matches the
+        # interface of the library and lets attention run as batched matmuls without transposes.
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError(
                 "You cannot specify both input_ids and inputs_embeds at the same time"
             )
         elif input_ids is not None:
-            input_ids = paddle.transpose(input_ids, perm=[1, 0])
-            qlen, bsz = input_ids.shape[0], input_ids.shape[1]
+            bsz, qlen = input_ids.shape[0], input_ids.shape[1]
         elif inputs_embeds is not None:
-            inputs_embeds = paddle.transpose(inputs_embeds, perm=[1, 0])
-            qlen, bsz = inputs_embeds.shape[0], inputs_embeds.shape[1]
+            bsz, qlen = inputs_embeds.shape[0], inputs_embeds.shape[1]
         else:
             raise ValueError(
                 "You have to specify either input_ids or inputs_embeds")
 
-        token_type_ids = token_type_ids.transpose(
-            [1, 0]) if token_type_ids is not None else None
-        input_mask = input_mask.transpose(
-            [1, 0]) if input_mask is not None else None
-        attention_mask = attention_mask.transpose(
-            [1, 0]) if attention_mask is not None else None
-        perm_mask = perm_mask.transpose(
-            [1, 2, 0]) if perm_mask is not None else None
-        target_mapping = target_mapping.transpose(
-            [1, 2, 0]) if target_mapping is not None else None
-
-        mlen = mems[0].shape[0] if mems is not None and mems[
+        mlen = mems[0].shape[1] if mems is not None and mems[
             0] is not None else 0
         klen = mlen + qlen
 
+        if input_mask is not None and attention_mask is not None:
+            raise ValueError(
+                "You can only use one of input_mask (uses 1 for padding) "
+                "or attention_mask (uses 0 for padding, added for compatibility with BERT). "
+                "Please choose one.")
         # Attention mask
-        # Causal attention mask
-        if self.attn_type == "uni":
-            attn_mask = self.create_mask(qlen, mlen)
-            attn_mask = paddle.unsqueeze(attn_mask, axis=[2, 3])
-        elif self.attn_type == "bi":
-            attn_mask = None
-        else:
-            raise ValueError("Unsupported attention type: {}".format(
-                self.attn_type))
-
-        # Data mask: input mask & perm mask
-        assert input_mask is None or attention_mask is None, "You can only use one of input_mask (uses 1 for padding) "
-        "or attention_mask (uses 0 for padding, added for compatibility with BERT). Please choose one."
-        if input_mask is None and attention_mask is not None:
-            input_mask = 1.0 - attention_mask
-        if input_mask is not None and perm_mask is not None:
-            data_mask = paddle.unsqueeze(input_mask, axis=0) + perm_mask
-        elif input_mask is not None and perm_mask is None:
-            data_mask = paddle.unsqueeze(input_mask, axis=0)
-        elif input_mask is None and perm_mask is not None:
-            data_mask = perm_mask
-        else:
-            data_mask = None
-
-        if data_mask is not None:
-            # All mems can be attended to
-            if mlen > 0:
-                mems_mask = paddle.cast(
-                    paddle.zeros([data_mask.shape[0], mlen, bsz]),
-                    dtype=dtype_float)
-                data_mask = paddle.concat([mems_mask, data_mask], axis=1)
-            if attn_mask is None:
-                attn_mask = paddle.unsqueeze(data_mask, axis=-1)
-            else:
-                attn_mask += paddle.unsqueeze(data_mask, axis=-1)
-
-        if attn_mask is not None:
-            attn_mask = paddle.cast((attn_mask > 0), dtype=dtype_float)
-
-        if attn_mask is not None:
-            non_tgt_mask = paddle.cast(-paddle.eye(qlen), dtype=dtype_float)
-
-            if mlen > 0:
-                non_tgt_mask = paddle.concat(
-                    [
-                        paddle.cast(
-                            paddle.zeros([qlen, mlen]), dtype=dtype_float),
-                        non_tgt_mask
-                    ],
-                    axis=-1)
-            non_tgt_mask = paddle.cast(
-                ((attn_mask + paddle.unsqueeze(
-                    non_tgt_mask, axis=[2, 3])) > 0),
-                dtype=dtype_float)
-        else:
-            non_tgt_mask = None
+        attn_mask, non_tgt_mask = self._prepare_masks(
+            qlen, mlen, attention_mask, input_mask, perm_mask)
 
         # Word embeddings and prepare h & g hidden states
         if inputs_embeds is not None:
@@ -1073,67 +1417,75 @@ class XLNetModel(XLNetPretrainedModel):
         else:
             word_emb_k = self.word_embedding(input_ids)
 
-        output_h = self.dropout(word_emb_k)
+        output_h = _dropout_in_train(self.dropout, word_emb_k)
         if target_mapping is not None:
+            # `target_mapping` is consumed as is by both G-stream matmuls of
+            # every layer, so it is only converted here, and only if needed
+            if target_mapping.dtype != word_emb_k.dtype:
+                target_mapping = paddle.cast(target_mapping, word_emb_k.dtype)
             word_emb_q = self.mask_emb.expand(
-                [target_mapping.shape[0], bsz, -1])
-            output_g = self.dropout(word_emb_q)
+                [bsz, target_mapping.shape[1], -1])
+            output_g = _dropout_in_train(self.dropout, word_emb_q)
         else:
             output_g = None
 
         # Segment embedding
         if token_type_ids is not None:
-            # Convert `token_type_ids` to one-hot `seg_mat`
+            # Convert `token_type_ids` to `seg_mat`
             if mlen > 0:
-                mem_pad = paddle.zeros(shape=[mlen, bsz], dtype='int64')
-                cat_ids = paddle.concat(x=[mem_pad, token_type_ids], axis=0)
+                mem_pad = paddle.zeros(shape=[bsz, mlen], dtype='int64')
+                cat_ids = paddle.concat(x=[mem_pad, token_type_ids], axis=1)
             else:
                 cat_ids = token_type_ids
 
-            # `1` indicates not in the same segment [qlen x klen x bsz]
+            # `1` indicates not in the same segment [bsz x 1 x qlen x klen]
             seg_mat = paddle.cast(
                 paddle.unsqueeze(
-                    token_type_ids, axis=1) != paddle.unsqueeze(
-                        cat_ids, axis=0),
-                dtype='int64')
-            seg_mat = paddle.cast(
-                F.one_hot(
-                    seg_mat, num_classes=2), dtype=dtype_float)
+                    token_type_ids, axis=[1, 3]) != paddle.unsqueeze(
+                        cat_ids, axis=[1, 2]),
+                dtype=word_emb_k.dtype)
         else:
             seg_mat = None
 
         # Positional encoding
-        pos_emb = self.relative_positional_encoding(qlen, klen, bsz=bsz)
-        pos_emb = self.dropout(pos_emb)
+        # Unless dropout draws a different mask for every example or the two
+        # halves of the batch use different directions, the encoding is the
+        # same across the batch and is broadcast instead of expanded.
+        if self.bi_data or (self.training and self.dropout.p > 0):
+            pos_emb = self.relative_positional_encoding(qlen, klen, bsz=bsz)
+        else:
+            pos_emb = self.relative_positional_encoding(qlen, klen)
+        pos_emb = _dropout_in_train(self.dropout, pos_emb)
 
         # Prepare head mask if needed
         # 1.0 in head_mask indicate we keep the head
         # Attention_probs has shape bsz x n_heads x N x N
         # Input head_mask has shape [num_heads] or [num_hidden_layers x num_heads] (a head_mask for each layer)
-        # And head_mask is converted to shape [num_hidden_layers x qlen x klen x bsz x n_head]
+        # And head_mask is reshaped to broadcast as [1 x n_head x 1 x 1] in each layer
         if head_mask is not None:
+            head_mask = paddle.cast(head_mask, word_emb_k.dtype)
             if head_mask.dim() == 1:
-                head_mask = head_mask.unsqueeze(0).unsqueeze(0).unsqueeze(
-                    0).unsqueeze(0)
-                head_mask = head_mask.expand([self.n_layer, -1, -1, -1, -1])
+                # The same mask is shared by all the layers
+                head_mask = [head_mask.reshape([1, -1, 1, 1])] * self.n_layer
             elif head_mask.dim() == 2:
-                head_mask = head_mask.unsqueeze(1).unsqueeze(1).unsqueeze(1)
+                head_mask = head_mask.reshape([0, 1, -1, 1, 1])
         else:
             head_mask = [None] * self.n_layer
 
-        new_mems = ()
         if mems is None:
             mems = [None] * len(self.layer)
 
+        # Per-layer outputs are only collected for the paths that need them;
+        # the (h, g) pairs are flattened once after the loop.
+        new_mems = [] if use_mems else None
         attentions = [] if return_dict else None
         hidden_states = [] if return_dict else None
         for i, layer_module in enumerate(self.layer):
             if use_mems:
                 # Cache new mems
-                new_mems = new_mems + (self.cache_mem(output_h, mems[i]), )
+                new_mems.append(self.cache_mem(output_h, mems[i]))
             if return_dict:
-                hidden_states.append((output_h, output_g)
-                                     if output_g is not None else output_h)
+                hidden_states.append((output_h, output_g))
 
             outputs = layer_module(
                 output_h,
@@ -1151,40 +1503,29 @@ class XLNetModel(XLNetPretrainedModel):
             if return_dict:
                 attentions.append(outputs[2])
 
-        # Add last hidden state
-        if return_dict:
-            hidden_states.append((output_h, output_g)
-                                 if output_g is not None else output_h)
-
-        output = self.dropout(output_g if output_g is not None else output_h)
-
-        # Prepare outputs, we transpose back here to shape [bsz, len, hidden_dim] (cf. beginning of forward() method)
-        output = paddle.transpose(output, perm=[1, 0, 2])
+        output = output_g if output_g is not None else output_h
+        if return_last_only:
+            # Sequence-level heads only read the last position, so the final
+            # dropout is not applied to the rest of the sequence
+            output = output[:, -1:]
+        output = _dropout_in_train(self.dropout, output)
 
-        if not use_mems:
-            new_mems = None
+        if use_mems:
+            new_mems = tuple(new_mems)
 
         if return_dict:
+            # Add last hidden state
+            hidden_states.append((output_h, output_g))
             if output_g is not None:
-                hidden_states = tuple(
-                    paddle.transpose(
-                        h, perm=[1, 0, 2]) for hs in hidden_states for h in hs)
+                hidden_states = tuple(h for hs in hidden_states for h in hs)
             else:
-                hidden_states = tuple(
-                    paddle.transpose(
-                        hs, perm=[1, 0, 2]) for hs in hidden_states)
+                hidden_states = tuple(hs[0] for hs in hidden_states)
 
             if target_mapping is not None:
                 # When target_mapping is provided, there are 2-tuple of attentions
-                attentions = tuple(
-                    tuple(
-                        paddle.transpose(
-                            att_stream, perm=[2, 3, 0, 1]) for att_stream in t)
-                    for t in attentions)
+                attentions = tuple(tuple(t) for t in attentions)
             else:
-                attentions = tuple(
-                    paddle.transpose(
-                        t, perm=[2, 3, 0, 1]) for t in attentions)
+                attentions = tuple(attentions)
 
         if return_dict:
             return {
@@ -1199,11 +1540,23 @@ class XLNetModel(XLNetPretrainedModel):
 class XLNetClassificationHead(Layer):
     """Head for sentence-level classification tasks."""
 
-    def __init__(self, hidden_size, dropout, num_classes):
+    def __init__(self,
+                 hidden_size,
+                 dropout,
+                 num_classes,
+                 initializer_range=0.02):
         super(XLNetClassificationHead, self).__init__()
-        self.dense = nn.Linear(hidden_size, hidden_size)
+        self.dense = nn.Linear(
+            hidden_size,
+            hidden_size,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range)))
         self.dropout = nn.Dropout(dropout)
-        self.out_proj = nn.Linear(hidden_size, num_classes)
+        self.out_proj = nn.Linear(
+            hidden_size,
+            num_classes,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=initializer_range)))
 
     def forward(self, features, **kwargs):
         x = features[:, -1, :]  # Take <cls> token
@@ -1233,8 +1586,8 @@ class XLNetForSequenceClassification(XLNetPretrainedModel):
         self.transformer = xlnet
         self.classifier = XLNetClassificationHead(
             self.transformer.d_model,
-            self.transformer.config["classifier_dropout"], num_classes)
-        self.init_weights()
+            self.transformer.config["classifier_dropout"], num_classes,
+            self.transformer.initializer_range)
 
     def forward(
             self,
@@ -1325,7 +1678,8 @@ class XLNetForSequenceClassification(XLNetPretrainedModel):
             inputs_embeds=inputs_embeds,
             use_mems_train=use_mems_train,
             use_mems_eval=use_mems_eval,
-            return_dict=return_dict, )
+            return_dict=return_dict,
+            return_last_only=True, )
         output = transformer_outputs if not return_dict \
             else transformer_outputs["last_hidden_state"]
         logits = self.classifier(output)
@@ -1357,9 +1711,11 @@ class XLNetForTokenClassification(XLNetPretrainedModel):
         self.num_classes = num_classes
 
         self.transformer = xlnet
-        self.classifier = nn.Linear(self.transformer.d_model, num_classes)
-
-        self.init_weights()
+        self.classifier = nn.Linear(
+            self.transformer.d_model,
+            num_classes,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=self.transformer.initializer_range)))
 
     def forward(
             self,
@@ -1483,7 +1839,6 @@ class XLNetLMHeadModel(XLNetPretrainedModel):
             shape=[self.transformer.config['vocab_size']],
             dtype=self.decoder_weight.dtype,
             is_bias=True)
-        self.init_weights()
 
     def forward(
             self,
@@ -1604,8 +1959,8 @@ class XLNetForMultipleChoice(XLNetPretrainedModel):
         self.transformer = xlnet
         self.classifier = XLNetClassificationHead(
             self.transformer.d_model,
-            self.transformer.config["classifier_dropout"], 1)
-        self.init_weights()
+            self.transformer.config["classifier_dropout"], 1,
+            self.transformer.initializer_range)
 
     def forward(
             self,
@@ -1734,7 +2089,8 @@ class XLNetForMultipleChoice(XLNetPretrainedModel):
             token_type_ids=token_type_ids,
             attention_mask=attention_mask,
             inputs_embeds=inputs_embeds,
-            return_dict=return_dict, )
+            return_dict=return_dict,
+            return_last_only=True, )
         output = transformer_outputs if not return_dict \
             else transformer_outputs["last_hidden_state"]
         logits = self.classifier(output)
@@ -1762,9 +2118,11 @@ class XLNetForQuestionAnswering(XLNetPretrainedModel):
     def __init__(self, xlnet):
         super(XLNetForQuestionAnswering, self).__init__()
         self.transformer = xlnet
-        self.qa_outputs = nn.Linear(self.transformer.d_model, 2)
-
-        self.init_weights()
+        self.qa_outputs = nn.Linear(
+            self.transformer.d_model,
+            2,
+            weight_attr=paddle.ParamAttr(initializer=nn.initializer.Normal(
+                mean=0.0, std=self.transformer.initializer_range)))
 
     def forward(
             self,
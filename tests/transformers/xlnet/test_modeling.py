@@ -14,11 +14,13 @@
 
 import numpy as np
 import os
+import tempfile
 import unittest
 import paddle
 import copy
+from paddle.static import InputSpec
 
-from paddlenlp.transformers import XLNetLMHeadModel, XLNetForMultipleChoice, XLNetForQuestionAnswering, XLNetModel
+from paddlenlp.transformers import XLNetLMHeadModel, XLNetForMultipleChoice, XLNetForQuestionAnswering, XLNetModel, XLNetForSequenceClassification
 
 from common_test import CommonTest
 from util import softmax_with_cross_entropy, slow
@@ -40,7 +42,7 @@ def create_input_data(config, seed=None):
     return input_ids
 
 
-class TestXLNetLMHeadModel(CommonTest):
+class XLNetTestBase(CommonTest):
     def set_input(self):
         self.config = copy.deepcopy(XLNetModel.pretrained_init_configuration[
             'xlnet-base-cased'])
@@ -53,6 +55,18 @@ class TestXLNetLMHeadModel(CommonTest):
         self.config['batch_size'] = 4
         self.input_ids = create_input_data(self.config)
 
+    def setUp(self):
+        self.set_input()
+
+    def _build_model(self, **kwargs):
+        config = copy.deepcopy(self.config)
+        del config['batch_size']
+        del config['seq_len']
+        config.update(kwargs)
+        return XLNetModel(**config)
+
+
+class TestXLNetLMHeadModel(XLNetTestBase):
     def set_output(self):
         self.expected_shape = (self.config['batch_size'],
                                self.config['seq_len'], self.config['d_model'])
@@ -69,11 +83,7 @@ class TestXLNetLMHeadModel(CommonTest):
         self.check_output_equal(self.output.numpy().shape, self.expected_shape)
 
     def test_forward(self):
-        config = copy.deepcopy(self.config)
-        del config['batch_size']
-        del config['seq_len']
-
-        xlnet = XLNetModel(**config)
+        xlnet = self._build_model()
         model = self.TEST_MODEL_CLASS(xlnet)
         input_ids = paddle.to_tensor(self.input_ids)
         self.output = model(input_ids, return_dict=False)
@@ -127,5 +137,307 @@ class TestXLNetForQuestionAnswering(TestXLNetLMHeadModel):
                                 self.expected_end_logit_shape)
 
 
+class TestXLNetLegacyStateDict(XLNetTestBase):
+    def _legacy_state_dict(self, model):
+        # Rebuild a state dict in the layout of the released checkpoints,
+        # with separate q, k and v and bare projection parameters.
+        legacy_state_dict = {}
+        for key, value in model.state_dict().items():
+            value = value.numpy()
+            if key.endswith("rel_attn.qkv.weight"):
+                prefix = key[:-len("qkv.weight")]
+                for name, weight in zip("qkv", np.split(value, 3, axis=1)):
+                    legacy_state_dict[prefix + name] = weight
+            elif key.endswith("rel_attn.o.weight"):
+                legacy_state_dict[key[:-len(".weight")]] = value.T
+            elif key.endswith("rel_attn.r.weight"):
+                legacy_state_dict[key[:-len(".weight")]] = value
+            else:
+                legacy_state_dict[key] = value
+        return legacy_state_dict
+
+    def test_forward(self):
+        model = self._build_model()
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        expected = model(input_ids, return_dict=False).numpy()
+        legacy_state_dict = self._legacy_state_dict(model)
+
+        # `set_dict` and `load_dict` are aliases of `set_state_dict`
+        for load_fn in ["set_state_dict", "set_dict", "load_dict"]:
+            new_model = self._build_model()
+            new_model.eval()
+            getattr(new_model, load_fn)(legacy_state_dict)
+            self.output = new_model(input_ids, return_dict=False).numpy()
+            self.check_output_equal(self.output, expected)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            model.save_pretrained(tempdir)
+            paddle.save({
+                key: paddle.to_tensor(value)
+                for key, value in legacy_state_dict.items()
+            }, os.path.join(tempdir, "model_state.pdparams"))
+            new_model = XLNetModel.from_pretrained(tempdir)
+        new_model.eval()
+        self.output = new_model(input_ids, return_dict=False).numpy()
+        self.check_output_equal(self.output, expected)
+
+
+class TestXLNetRelativeAttentionGradient(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        model.train()
+        input_ids = paddle.to_tensor(self.input_ids)
+        token_type_ids = paddle.to_tensor(
+            np.random.randint(
+                low=0, high=2, size=self.input_ids.shape))
+        output = model(input_ids, token_type_ids=token_type_ids)
+        # A random projection, as the sum of a layer norm output is constant
+        loss = (output * paddle.randn(output.shape)).sum()
+        loss.backward()
+
+        # The positional and segment scores are trained in every layer
+        for layer in model.layer:
+            rel_attn = layer.rel_attn
+            for param in [
+                    rel_attn.r.weight, rel_attn.r_r_bias, rel_attn.r_s_bias,
+                    rel_attn.seg_embed
+            ]:
+                self.assertIsNotNone(param.grad)
+                self.assertGreater(float(param.grad.abs().max()), 0)
+
+
+class TestXLNetMems(XLNetTestBase):
+    def test_forward(self):
+        mem_len = self.config['seq_len'] // 2
+        model = self._build_model(attn_type='uni', mem_len=mem_len)
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        expected = model(input_ids).numpy()
+
+        # With causal attention, the second half attending to the mems of
+        # the first half gives the same output as the full sequence
+        first = model(
+            input_ids[:, :mem_len], use_mems_eval=True, return_dict=True)
+        second = model(
+            input_ids[:, mem_len:],
+            mems=first["mems"],
+            use_mems_eval=True,
+            return_dict=True)
+        for mems in [first["mems"], second["mems"]]:
+            self.check_output_equal(len(mems), self.config['n_layer'])
+            for mem in mems:
+                self.check_output_equal(
+                    tuple(mem.shape),
+                    (self.config['batch_size'], mem_len,
+                     self.config['d_model']))
+        self.output = second["last_hidden_state"].numpy()
+        self.check_output_equal(
+            self.output, expected[:, mem_len:], atol=1e-5)
+
+
+class TestXLNetMaskConflict(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        input_ids = paddle.to_tensor(self.input_ids)
+        attention_mask = paddle.ones(input_ids.shape, dtype='float32')
+        input_mask = 1.0 - attention_mask
+        with self.assertRaises(ValueError):
+            model(
+                input_ids,
+                attention_mask=attention_mask,
+                input_mask=input_mask)
+
+
+class TestXLNetReturnLastOnly(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        expected = model(input_ids).numpy()[:, -1:]
+        self.output = model(input_ids, return_last_only=True).numpy()
+        self.check_output_equal(
+            self.output.shape,
+            (self.config['batch_size'], 1, self.config['d_model']))
+        self.check_output_equal(self.output, expected)
+
+
+class TestXLNetDynamicBatchExport(XLNetTestBase):
+    def test_forward(self):
+        model = XLNetForSequenceClassification(self._build_model())
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        token_type_ids = paddle.to_tensor(
+            np.random.randint(
+                low=0, high=2, size=self.input_ids.shape))
+        expected = model(input_ids, token_type_ids=token_type_ids).numpy()
+
+        seq_len = self.config['seq_len']
+        static_model = paddle.jit.to_static(
+            model,
+            input_spec=[
+                InputSpec([None, seq_len], 'int64'),
+                InputSpec([None, seq_len], 'int64')
+            ],
+            full_graph=True)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'model')
+            paddle.jit.save(static_model, path)
+            loaded_model = paddle.jit.load(path)
+
+        # The exported program runs with any batch size
+        self.output = loaded_model(input_ids, token_type_ids).numpy()
+        self.check_output_equal(self.output, expected, atol=1e-5)
+        self.output = loaded_model(input_ids[:1], token_type_ids[:1]).numpy()
+        self.check_output_equal(self.output, expected[:1], atol=1e-5)
+
+
+class TestXLNetCastDtype(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        token_type_ids = paddle.to_tensor(
+            np.random.randint(
+                low=0, high=2, size=self.input_ids.shape))
+        expected = model(input_ids, token_type_ids=token_type_ids).numpy()
+
+        # Half precision matmuls are only available on GPU
+        dtypes = [('float64', 1e-4)]
+        if paddle.get_device().startswith('gpu'):
+            dtypes.append(('float16', 1e-2))
+        for dtype, tol in dtypes:
+            cast_model = self._build_model()
+            cast_model.set_state_dict(model.state_dict())
+            cast_model.to(dtype=dtype)
+            cast_model.eval()
+            output = cast_model(input_ids, token_type_ids=token_type_ids)
+            self.check_output_equal(str(output.dtype), 'paddle.' + dtype)
+            self.output = output.astype('float32').numpy()
+            self.check_output_equal(self.output, expected, rtol=tol, atol=tol)
+
+
+class TestXLNetTargetMapping(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        model.eval()
+        batch_size, seq_len = self.config['batch_size'], self.config['seq_len']
+        input_ids = paddle.to_tensor(self.input_ids)
+        perm_mask = paddle.to_tensor(
+            (np.random.rand(batch_size, seq_len, seq_len) > 0.5).astype(
+                'float32'))
+
+        # Every prediction of the query stream only depends on its target
+        # position, so predicting a subset of the positions in any order
+        # gives the same rows as predicting all of them
+        eye = np.eye(seq_len, dtype='float32')
+        positions = np.random.permutation(seq_len)[:seq_len // 4]
+        outputs = []
+        for mapping in [eye, eye[positions]]:
+            target_mapping = paddle.to_tensor(
+                np.tile(mapping[None], [batch_size, 1, 1]))
+            outputs.append(
+                model(
+                    input_ids,
+                    perm_mask=perm_mask,
+                    target_mapping=target_mapping).numpy())
+        self.output = outputs[1]
+        self.check_output_equal(
+            self.output, outputs[0][:, positions], atol=1e-5)
+
+
+class TestXLNetHeadMask(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model()
+        model.eval()
+        n_layer, n_head = self.config['n_layer'], self.config['n_head']
+        input_ids = paddle.to_tensor(self.input_ids)
+        expected = model(input_ids).numpy()
+
+        # A mask of ones keeps every head
+        self.output = model(
+            input_ids, head_mask=paddle.ones([n_layer, n_head])).numpy()
+        self.check_output_equal(self.output, expected, atol=1e-6)
+
+        # A per-layer mask with the same row for every layer is the same as
+        # the shared mask
+        head_mask = (np.arange(n_head) % 2).astype('float32')
+        expected = model(
+            input_ids, head_mask=paddle.to_tensor(head_mask)).numpy()
+        self.output = model(
+            input_ids,
+            head_mask=paddle.to_tensor(np.tile(head_mask, [n_layer, 1])),
+            return_dict=True)["last_hidden_state"].numpy()
+        self.check_output_equal(self.output, expected, atol=1e-6)
+
+        # Masking heads of the last layer only leaves the first one unchanged
+        layer_head_mask = np.ones([n_layer, n_head], dtype='float32')
+        layer_head_mask[-1] = head_mask
+        outputs = model(
+            input_ids,
+            head_mask=paddle.to_tensor(layer_head_mask),
+            return_dict=True)
+        unmasked_outputs = model(input_ids, return_dict=True)
+        self.check_output_equal(outputs["hidden_states"][1].numpy(),
+                                unmasked_outputs["hidden_states"][1].numpy())
+        self.assertFalse(
+            np.allclose(outputs["last_hidden_state"].numpy(),
+                        unmasked_outputs["last_hidden_state"].numpy()))
+
+
+class TestXLNetCausalMaskCache(XLNetTestBase):
+    def test_forward(self):
+        model = self._build_model(attn_type='uni')
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        short_input_ids = input_ids[:, :self.config['seq_len'] // 2]
+
+        # A model that has not seen any other shape gives the reference
+        reference_model = self._build_model(attn_type='uni')
+        reference_model.set_state_dict(model.state_dict())
+        reference_model.eval()
+        expected = reference_model(short_input_ids).numpy()
+
+        # The causal masks of both lengths are cached and reused
+        first = model(input_ids).numpy()
+        self.output = model(short_input_ids).numpy()
+        self.check_output_equal(self.output, expected)
+        cache_size = len(model._mask_cache)
+        self.output = model(input_ids).numpy()
+        self.check_output_equal(self.output, first)
+        self.check_output_equal(len(model._mask_cache), cache_size)
+
+
+class TestXLNetNonTargetMaskCache(XLNetTestBase):
+    def test_forward(self):
+        mem_len = self.config['seq_len'] // 2
+        model = self._build_model(mem_len=mem_len)
+        model.eval()
+        input_ids = paddle.to_tensor(self.input_ids)
+        attention_mask = paddle.to_tensor(
+            (np.random.rand(*self.input_ids.shape) > 0.2).astype('float32'))
+        mems = model(
+            input_ids[:, :mem_len], use_mems_eval=True,
+            return_dict=True)["mems"]
+
+        # The same query length with and without mems needs two different
+        # non-target patterns, each of them is checked against a model
+        # that has not cached any other one
+        kwargs_list = [
+            dict(attention_mask=attention_mask),
+            dict(attention_mask=attention_mask, mems=mems),
+        ]
+        expected = []
+        for kwargs in kwargs_list:
+            reference_model = self._build_model(mem_len=mem_len)
+            reference_model.set_state_dict(model.state_dict())
+            reference_model.eval()
+            expected.append(reference_model(input_ids, **kwargs).numpy())
+        for _ in range(2):
+            for kwargs, expected_output in zip(kwargs_list, expected):
+                self.output = model(input_ids, **kwargs).numpy()
+                self.check_output_equal(self.output, expected_output)
+
+
 if __name__ == "__main__":
     unittest.main()